@@ -1,12 +1,23 @@
+import ctypes
+import errno
+import hashlib
+import multiprocessing
 import os
+import queue
+import struct
+import sys
 import shutil
 import argparse
+from collections import deque
+from contextlib import nullcontext
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 # --- Configuration ---
 
 # Define supported extensions (non-Advanced based on your list) - lowercase
 # Excludes: XLS, XLSX, CSV, TSV (marked as Advanced only)
-SUPPORTED_EXTENSIONS = {
+SUPPORTED_EXTENSIONS = frozenset({
     # Code
     'c', 'cpp', 'py', 'java', 'php', 'sql', 'html',
     # Document
@@ -17,10 +28,10 @@ SUPPORTED_EXTENSIONS = {
     'pptx',
     # Note: Google Docs/Sheets/Slides are web formats, not typically local files
     # in a way this script processes. Users would export them first.
-}
+})
 
 # Define extensions to ignore completely (common multimedia, archives, etc.) - lowercase
-IGNORED_EXTENSIONS = {
+IGNORED_EXTENSIONS = frozenset({
     # Images
     'jpg', 'jpeg', 'png', 'gif', 'bmp', 'tiff', 'svg', 'webp', 'ico',
     # Audio
@@ -40,23 +51,360 @@ IGNORED_EXTENSIONS = {
     # IDE/Build tool specific folders/files (often contain generated/binary)
     'o', 'a', 'lib', 'class', 'pyc', 'pyd', # Common build artifacts
     # Add more extensions here if needed
-}
+})
 
 # Size limit for warning
 MAX_SIZE_MB = 100
 MAX_SIZE_BYTES = MAX_SIZE_MB * 1024 * 1024
 
+# Buffer size for file writes during conversion (128 KiB)
+IO_BUFFER_SIZE = 1 << 17
+
+# Chunk size for streaming conversion, keeps memory flat regardless of file size (1 MiB)
+CONVERT_CHUNK_SIZE = 1 << 20
+
+# Binary detection: bytes sampled from the start of a file before converting it,
+# and the max share of invalid UTF-8 / control characters still treated as text
+BINARY_SNIFF_SIZE = 8192
+BINARY_MAX_RATIO = 0.10
+# Control characters that don't appear in text (tab, newlines, form feed, escape, etc. are allowed)
+CONTROL_BYTES = bytes(b for b in range(32) if b not in b'\a\b\t\n\f\r\x1b') + b'\x7f'
+
+# Copy supported files in-kernel with posix_fadvise (Linux); elsewhere use shutil.copyfile
+USE_SENDFILE = sys.platform.startswith('linux') and hasattr(os, 'posix_fadvise')
+
+# Max bytes per os.copy_file_range / os.sendfile call (1 GiB, same cap shutil uses)
+SENDFILE_CHUNK_SIZE = 1 << 30
+
+# copy_file_range errors that mean "use sendfile instead" (old kernel, cross-filesystem, etc.)
+COPY_FILE_RANGE_UNSUPPORTED = frozenset({errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                                         errno.EOPNOTSUPP, errno.EPERM})
+
+# statx() constants from <linux/stat.h> / <fcntl.h>
+AT_FDCWD = -100
+AT_STATX_DONT_SYNC = 0x4000
+STATX_SIZE = 0x200
+STATX_BUF_SIZE = 256    # sizeof(struct statx)
+STATX_SIZE_OFFSET = 40  # offsetof(struct statx, stx_size)
+
+# Written in place of files that look binary (filename, original extension)
+BINARY_PLACEHOLDER = b"[Content of '%s' could not be decoded as text (likely binary). Original extension: %s]"
+
+# Digest of an empty file; empty files are never skipped as duplicates
+EMPTY_DIGEST = hashlib.blake2b(b'', digest_size=16).digest()
+
+# Output file listing skipped duplicates as "<source path> -> <file kept in the output>"
+DUPLICATES_LIST_NAME = b'_duplicates.txt'
+DUPLICATES_LIST_HEADER = b"Files skipped because their content is identical to a file already in this folder:\n"
+
+# Worker threads for copying/converting files; I/O bound, so more than the core count
+MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Max copy/convert jobs submitted but not yet collected
+MAX_IN_FLIGHT = MAX_WORKERS * 16
+
+# Print a progress line every PROGRESS_MASK + 1 (4096) finished files
+PROGRESS_MASK = 0xFFF
+
 # --- Helper Functions ---
 
 def get_safe_filename(name):
     """Removes potentially problematic characters for filenames, though '%' is kept for hierarchy."""
     # Basic sanitization - you might want to expand this if needed
     # For now, primarily ensures it doesn't contain path separators by mistake after replacements
+    if isinstance(name, bytes):
+        return name.replace(b'/', b'_').replace(b'\\', b'_')
     return name.replace('/', '_').replace('\\', '_')
 
+def looks_binary(head):
+    """
+    Guesses whether a file is binary from its first few KiB.
+
+    Any NUL byte means binary; otherwise the file is binary if undecodable UTF-8
+    sequences plus control characters exceed BINARY_MAX_RATIO of the sample.
+    """
+    if b'\x00' in head:
+        return True
+    invalid = head.decode('utf-8', errors='replace').count('\ufffd')
+    control = len(head) - len(head.translate(None, CONTROL_BYTES))
+    return invalid + control > len(head) * BINARY_MAX_RATIO
+
+def utf8_boundary(data):
+    """Returns the index where an incomplete trailing UTF-8 sequence starts, or len(data)."""
+    end = len(data)
+    # A UTF-8 sequence is at most 4 bytes, so only the last 3 can be an unfinished one
+    for i in range(end - 1, max(end - 4, -1), -1):
+        byte = data[i]
+        if byte < 0x80:
+            return end
+        if byte >= 0xC0:
+            # Lead byte: check whether the rest of its sequence fits in data
+            needed = 2 if byte < 0xE0 else 3 if byte < 0xF0 else 4
+            return i if end - i < needed else end
+    return end
+
+def transcode_utf8(data):
+    """Decodes bytes as UTF-8, replacing errors, and re-encodes them. Runs in the process pool."""
+    return data.decode('utf-8', errors='replace').encode('utf-8')
+
+def convert_to_text(source_path, target_path, transcode_pool=None, hasher=None):
+    """
+    Streams a file into target_path as UTF-8 text, replacing undecodable bytes.
+
+    The first BINARY_SNIFF_SIZE bytes are checked with looks_binary() before
+    target_path is created; UnicodeDecodeError is raised if the file looks binary.
+    The rest is read in CONVERT_CHUNK_SIZE chunks into a reused buffer, so memory
+    use does not depend on the file size. Full chunks are transcoded on
+    transcode_pool (if given) while the next chunk is read; shorter ones are done
+    inline since they aren't worth the IPC. If hasher is given, it is updated with
+    the raw source bytes. Returns the number of bytes written.
+    """
+    with open(source_path, 'rb', buffering=0) as infile:
+        head = infile.read(BINARY_SNIFF_SIZE)
+        if looks_binary(head):
+            raise UnicodeDecodeError('utf-8', head, 0, len(head), 'file looks binary')
+
+        if hasher is not None:
+            hasher.update(head)
+
+        buf = bytearray(CONVERT_CHUNK_SIZE)
+        view = memoryview(buf)
+        # Pool only: the previous full chunk, still being transcoded while this one is read
+        pending = None
+        bytes_written = 0
+        with open(target_path, 'wb', buffering=IO_BUFFER_SIZE) as outfile:
+            # The sniffed head is the start of the first chunk
+            carry = head
+            while True:
+                n = infile.readinto(buf)
+                if not n:
+                    break
+                if hasher is not None:
+                    hasher.update(view[:n])
+                data = carry + view[:n]
+                # Hold back a multi-byte sequence split across chunks
+                cut = utf8_boundary(data)
+                data, carry = data[:cut], data[cut:]
+                if transcode_pool is None:
+                    bytes_written += outfile.write(transcode_utf8(data))
+                    continue
+                if pending is not None:
+                    bytes_written += outfile.write(pending.result())
+                    pending = None
+                if n == CONVERT_CHUNK_SIZE:
+                    pending = transcode_pool.submit(transcode_utf8, data)
+                else:
+                    bytes_written += outfile.write(transcode_utf8(data))
+            if pending is not None:
+                bytes_written += outfile.write(pending.result())
+            bytes_written += outfile.write(transcode_utf8(carry))
+    return bytes_written
+
+# Set per run by prepare_gemini_upload (same filesystem on both sides); reset to
+# False if the kernel rejects copy_file_range
+_use_copy_file_range = False
+
+def _load_statx():
+    """Returns libc's statx() via ctypes, or None if this isn't Linux/glibc 2.28+."""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        statx = libc.statx
+    except (OSError, AttributeError):
+        return None
+    statx.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_uint, ctypes.c_void_p]
+    statx.restype = ctypes.c_int
+    return statx
+
+# Probed once at import; reset to None if the kernel rejects statx at runtime
+_statx = _load_statx()
+
+def file_size(path):
+    """
+    Returns the size of path in bytes, following symlinks.
+
+    On Linux this asks statx() for STATX_SIZE only, with AT_STATX_DONT_SYNC so
+    network filesystems can answer from cache; otherwise it falls back to os.stat.
+    """
+    global _statx
+    statx = _statx
+    if statx is not None:
+        buf = ctypes.create_string_buffer(STATX_BUF_SIZE)
+        if statx(AT_FDCWD, os.fsencode(path), AT_STATX_DONT_SYNC, STATX_SIZE, buf) == 0:
+            mask, = struct.unpack_from('=I', buf, 0)
+            if mask & STATX_SIZE:
+                size, = struct.unpack_from('=Q', buf, STATX_SIZE_OFFSET)
+                return size
+        else:
+            err = ctypes.get_errno()
+            if err not in (errno.ENOSYS, errno.EPERM):
+                raise OSError(err, os.strerror(err), path)
+            # statx blocked (old kernel or seccomp filter), stop trying it
+            _statx = None
+    return os.stat(path).st_size
+
+def kernel_copy(source_path, target_path):
+    """
+    Copies source_path to target_path without passing the data through user space
+    (Linux only).
+
+    Uses os.copy_file_range when enabled for this run (it can reflink on btrfs/xfs),
+    continuing with an os.sendfile loop if the kernel or filesystem rejects it. The
+    source is advised as sequential before the copy and dropped from the page cache
+    afterwards, since its pages won't be read again. Returns the number of bytes copied.
+    """
+    global _use_copy_file_range
+    copied = 0
+    src_fd = os.open(source_path, os.O_RDONLY)
+    try:
+        dst_fd = os.open(target_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            if _use_copy_file_range:
+                try:
+                    while True:
+                        sent = os.copy_file_range(src_fd, dst_fd, SENDFILE_CHUNK_SIZE)
+                        if sent == 0:
+                            break
+                        copied += sent
+                except OSError as e:
+                    if e.errno not in COPY_FILE_RANGE_UNSUPPORTED:
+                        raise
+                    # Not supported here, stop trying it. Both calls advance the file
+                    # offsets, so sendfile below picks up where this left off
+                    _use_copy_file_range = False
+            while True:
+                sent = os.sendfile(dst_fd, src_fd, None, SENDFILE_CHUNK_SIZE)
+                if sent == 0:
+                    break
+                copied += sent
+            os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    return copied
+
+def new_content_hasher():
+    """Returns the hash object used to detect duplicate file contents."""
+    return hashlib.blake2b(digest_size=16)
+
+def hash_file(path):
+    """Returns the content digest of the file at path."""
+    hasher = new_content_hasher()
+    buf = bytearray(CONVERT_CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as infile:
+        while True:
+            n = infile.readinto(buf)
+            if not n:
+                break
+            hasher.update(view[:n])
+    return hasher.digest()
+
+def copy_file_data(source_path, target_path):
+    """Copies source_path to target_path with the fastest available method. Returns bytes copied."""
+    if USE_SENDFILE:
+        try:
+            return kernel_copy(source_path, target_path)
+        except OSError as e:
+            # Filesystem doesn't support sendfile, fall back to shutil below
+            if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                raise
+    # Timestamps/permissions don't matter for the upload, so skip copystat
+    # and let copyfile use the platform fast path (sendfile/fcopyfile)
+    shutil.copyfile(source_path, target_path)
+    return file_size(source_path)
+
+def copy_supported_file(entry, target_path, seen_digests):
+    """
+    Copies a supported file as-is. Returns (content digest, bytes written); bytes
+    written is None if the copy was skipped because the content is already owned by
+    an earlier file.
+    """
+    # seen_digests only holds owners already settled by the collector, which are all
+    # earlier in walk order than this job, so skipping here is deterministic. The copy
+    # below is then served from the page cache the hash read just populated
+    digest = hash_file(entry.path)
+    if digest in seen_digests and digest != EMPTY_DIGEST:
+        return digest, None
+    return digest, copy_file_data(entry.path, target_path)
+
+def copy_unique_file(entry, target_path):
+    """
+    Copies a supported file without hashing it, for files no earlier file shares a
+    size with. Returns (None, bytes written).
+    """
+    return None, copy_file_data(entry.path, target_path)
+
+def write_bytes(path, data):
+    """Writes data to path with raw os.write calls, skipping the Python file object layers."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+def make_transcode_pool(processes):
+    """
+    Returns a ProcessPoolExecutor with `processes` workers for transcode_utf8(), or None
+    if processes is 0, there is only one CPU (the IPC would just add to the same
+    core's work), or multiprocessing is unavailable.
+    """
+    if processes <= 0 or (os.cpu_count() or 1) <= 1:
+        return None
+    # Workers are started by submit() calls from the I/O threads, so never fork:
+    # forking a multi-threaded process can deadlock the child
+    start_methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in start_methods else 'spawn')
+    try:
+        return ProcessPoolExecutor(max_workers=processes, mp_context=context)
+    except (ImportError, NotImplementedError, OSError, ValueError):
+        # e.g. no working sem_open (some containers, Android); convert on the I/O threads
+        return None
+
+def convert_file(entry, target_path, transcode_pool=None):
+    """
+    Converts a file to .txt, writing a placeholder instead if it can't be decoded.
+    Returns (content digest, bytes written); the digest is None for placeholders,
+    which are never deduplicated.
+    """
+    source_path = entry.path
+    filename = entry.name
+    try:
+        # Stream the file into the new .txt file as UTF-8, replacing errors,
+        # hashing the source on the way through
+        hasher = new_content_hasher()
+        bytes_written = convert_to_text(source_path, target_path, transcode_pool, hasher)
+        return hasher.digest(), bytes_written
+    except UnicodeDecodeError:
+        # File is likely binary
+        placeholder = BINARY_PLACEHOLDER % (filename, os.path.splitext(filename)[1])
+        write_bytes(target_path, placeholder)
+        return None, len(placeholder)
+
+# Extension -> (handler, target suffix), or None for ignored extensions. Anything
+# not listed is converted; one dict lookup replaces the ignored/supported checks.
+# Keyed by bytes since the walk uses bytes paths
+CONVERT_HANDLER = (convert_file, b'.txt')
+EXTENSION_HANDLERS = {ext.encode(): (copy_supported_file, b'') for ext in SUPPORTED_EXTENSIONS}
+EXTENSION_HANDLERS.update({ext.encode(): None for ext in IGNORED_EXTENSIONS})
+
 # --- Core Logic ---
 
-def prepare_gemini_upload(input_dir, output_dir):
+def format_error(error):
+    """Formats one (is_conversion, source path, target path, error) entry for stderr."""
+    is_conversion, source_path, target_path, e = error
+    if source_path is None:
+        return f"Error writing duplicate file list {os.fsdecode(target_path)}: {e}\n"
+    if is_conversion:
+        return f"Error processing/converting {os.fsdecode(source_path)} to {os.fsdecode(target_path)}: {e}\n"
+    return f"Error copying {os.fsdecode(source_path)} to {os.fsdecode(target_path)}: {e}\n"
+
+def prepare_gemini_upload(input_dir, output_dir, transcode_processes=0):
     """
     Prepares a folder for uploading to Gemini's code feature by flattening the
     structure, converting unsupported text-like files to .txt, and ignoring
@@ -65,6 +413,8 @@ def prepare_gemini_upload(input_dir, output_dir):
     Args:
         input_dir (str): Path to the source directory.
         output_dir (str): Path to the destination directory to be created.
+        transcode_processes (int): Worker processes for re-encoding large text files.
+            0 (the default) converts on the I/O threads.
     """
     if not os.path.isdir(input_dir):
         print(f"Error: Input directory '{input_dir}' not found or is not a directory.")
@@ -79,19 +429,26 @@ def prepare_gemini_upload(input_dir, output_dir):
          print(f"Error: Output directory '{output_dir}' cannot be inside the input directory '{input_dir}'.")
          return
 
-    if os.path.exists(output_dir):
-        if not os.path.isdir(output_dir):
+    # Try to create the directory first and only inspect it if it already exists,
+    # instead of separate exists/isdir/listdir checks (also avoids a check-then-create race)
+    try:
+        os.makedirs(output_dir)
+        print(f"Created output directory: '{output_dir}'")
+    except FileExistsError:
+        try:
+            with os.scandir(output_dir) as it:
+                not_empty = next(it, None) is not None
+        except NotADirectoryError:
             print(f"Error: Output path '{output_dir}' exists but is not a directory.")
             return
-        elif os.listdir(output_dir):
-            print(f"Warning: Output directory '{output_dir}' exists and is not empty. Files might be overwritten.")
-    else:
-        try:
-            os.makedirs(output_dir)
-            print(f"Created output directory: '{output_dir}'")
         except OSError as e:
-            print(f"Error: Could not create output directory '{output_dir}': {e}")
+            print(f"Error: Could not read output directory '{output_dir}': {e}")
             return
+        if not_empty:
+            print(f"Warning: Output directory '{output_dir}' exists and is not empty. Files might be overwritten.")
+    except OSError as e:
+        print(f"Error: Could not create output directory '{output_dir}': {e}")
+        return
 
     print(f"\nProcessing files from '{input_dir}' into '{output_dir}'...")
 
@@ -103,109 +460,285 @@ def prepare_gemini_upload(input_dir, output_dir):
 
     # Common directories to skip
     skip_dirs = {'.git', '.svn', '.vscode', '.idea', 'node_modules', '__pycache__', 'venv', '.env'}
-
-    for root, dirs, files in os.walk(input_dir, topdown=True):
-        # Modify dirs in-place to prevent descending into skipped/hidden directories
-        # This is the primary mechanism for skipping whole directories
-        dirs[:] = [d for d in dirs if d not in skip_dirs and not d.startswith('.')]
-
-        # Skip processing the output directory itself if os.walk picks it up
-        if os.path.abspath(root).startswith(output_dir):
-             continue
-
-        relative_dir_path = os.path.relpath(root, input_dir)
-
-        for filename in files:
-            # Skip hidden files (e.g., .gitignore, .env)
-            if filename.startswith('.'):
-                ignored_files += 1
+    # Bound method so the per-directory check doesn't look up __contains__ each time
+    is_skipped_dir = {os.fsencode(d) for d in skip_dirs}.__contains__
+
+    # The walk works on bytes paths: they go straight to the syscalls without a
+    # str -> filesystem encoding step each time. Only messages decode them
+    sep = os.fsencode(os.sep)
+    output_join = os.fsencode(output_dir) + sep
+    # Local name for the per-file lookup (LOAD_FAST instead of LOAD_GLOBAL)
+    handlers = EXTENSION_HANDLERS
+
+    # Identify the output directory by (device, inode) so the walk can skip it
+    # without normalizing every visited path; this also catches symlink aliases
+    out_stat = os.stat(output_dir)
+    output_id = (out_stat.st_dev, out_stat.st_ino)
+    out_ino = out_stat.st_ino
+    in_stat = os.stat(input_dir)
+
+    # copy_file_range only helps (and before Linux 5.3 only works) within one
+    # filesystem, so try it only when input and output share a device
+    global _use_copy_file_range
+    _use_copy_file_range = (USE_SENDFILE and hasattr(os, 'copy_file_range')
+                            and in_stat.st_dev == out_stat.st_dev)
+
+    # Directories still to scan, as (path, filename prefix for the files inside it)
+    pending_dirs = [] if (in_stat.st_dev, in_stat.st_ino) == output_id else [(os.fsencode(input_dir), b'')]
+
+    # Decoding/encoding large text files is CPU bound and holds the GIL, so their
+    # chunks can go to a process pool (opt-in); workers are only started on first use
+    transcode_pool = make_transcode_pool(transcode_processes)
+
+    # Content digest -> target path of the file that owns that content. Ownership is
+    # settled by collect() in walk order, so the same files are kept on every run,
+    # and (source path, owner target) for each duplicate skipped
+    seen_digests = {}
+    duplicates = []
+
+    # Each handler with the per-run state it needs bound in, so both run as
+    # handler(entry, target_path) on the thread pool
+    bound_handlers = {
+        copy_supported_file: partial(copy_supported_file, seen_digests=seen_digests),
+        convert_file: partial(convert_file, transcode_pool=transcode_pool),
+    }
+
+    # Files can only share content with files of the same size, so a copy is only
+    # hashed once another file of its size has been seen; unique sizes keep the
+    # zero-copy path. Size -> source path of the first copy of that size, None once
+    # it has been hashed (or if the first file was a conversion, which is always hashed)
+    first_of_size = {}
+    # Size -> target path of the first copy of that size, once it was written unhashed
+    unhashed_owners = {}
+
+    # Flattened target names already handed out, so two sources that flatten to the
+    # same name (e.g. 'a%b/c.txt' and 'a/b/c.txt') are caught here instead of racing
+    used_targets = set()
+    errors = []
+
+    def collect(job):
+        """
+        Waits for a submitted job and folds its result into the counters. Jobs are
+        collected in submission order, so the first file with a given content that
+        was written successfully owns it; later copies are removed.
+        """
+        nonlocal total_size, processed_files, converted_files
+        future, is_conversion, source_path, target_path, size, pair_future = job
+        if pair_future is not None:
+            # This is the second file of its size, so the first one was hashed
+            # alongside it; register it as the owner of its content first
+            owner = unhashed_owners.pop(size, None)
+            try:
+                pair_digest = pair_future.result()
+            except Exception:
+                # The first file is already copied and counted, it just can't own
+                # its content; this file then owns it instead
+                owner = None
+            if owner is not None:
+                seen_digests[pair_digest] = owner
+        try:
+            digest, bytes_written = future.result()
+        except Exception as e:
+            # A failed owner never registers its digest, so the next file with the
+            # same content becomes the owner instead
+            errors.append((is_conversion, source_path, target_path, e))
+            return
+        if digest is not None and digest != EMPTY_DIGEST:
+            owner = seen_digests.get(digest)
+            if owner is not None:
+                if bytes_written is not None:
+                    # Written before the owner was settled, remove the extra copy
+                    try:
+                        os.remove(target_path)
+                    except OSError as e:
+                        errors.append((is_conversion, source_path, target_path, e))
+                        return
+                duplicates.append((source_path, owner))
+                return
+            seen_digests[digest] = target_path
+        elif digest is None and not is_conversion:
+            # Copied unhashed, hashed later if another file of its size shows up
+            unhashed_owners[size] = target_path
+        total_size += bytes_written
+        processed_files += 1
+        if is_conversion:
+            converted_files += 1
+
+    # Worker threads push each job's future here when it finishes, so progress
+    # follows completion order rather than submission order
+    done_queue = queue.SimpleQueue()
+    finished_files = 0
+
+    def drain(max_in_flight):
+        """
+        Reports progress for jobs finished since the last call and collects the finished
+        jobs at the front of in_flight. Blocks until fewer than max_in_flight jobs remain.
+        """
+        nonlocal finished_files
+        while True:
+            while in_flight and in_flight[0][0].done():
+                collect(in_flight.popleft())
+            try:
+                done_queue.get(block=len(in_flight) >= max_in_flight)
+            except queue.Empty:
+                return
+            finished_files += 1
+            if not finished_files & PROGRESS_MASK:
+                sys.stdout.write(f"  ... {finished_files} files done\n")
+
+    # Copy/convert jobs run on a thread pool so file I/O overlaps (the GIL is released
+    # during the syscalls); the walk itself stays on this thread. At most
+    # MAX_IN_FLIGHT jobs are outstanding, so memory doesn't grow with the tree size
+    in_flight = deque()
+    # The transcode pool is listed first so it is shut down last, after the I/O
+    # threads using it, and also when the walk is aborted by an exception
+    with transcode_pool or nullcontext(), ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # Walk the tree with os.scandir so each directory is listed in one pass and
+        # entries are classified from the cached DirEntry type, without a stat per file
+        while pending_dirs:
+            # new_prefix is the flattened relative path (b'' for the root input directory),
+            # built from the parent's prefix when the directory was queued
+            root, new_prefix = pending_dirs.pop()
+            root_prefix = root + sep
+
+            try:
+                scan_it = os.scandir(root)
+            except OSError:
+                # Unreadable directory, skip it (same as os.walk's default)
                 continue
 
-            source_path = os.path.join(root, filename)
-            base_name, ext = os.path.splitext(filename)
-            file_ext_lower = ext[1:].lower() if ext else ''
-
-            # --- 1. Check if extension is explicitly ignored ---
-            #    (The check for ignored *directories* is handled by dirs[:] above)
-            if file_ext_lower in IGNORED_EXTENSIONS:
-                ignored_files += 1
-                # print(f"Ignoring: {source_path} (Ignored Extension: {file_ext_lower})")
-                continue
-            # --- V V V FAULTY CHECK REMOVED HERE V V V ---
-            # is_ignored_dir = any(part in skip_dirs or part.startswith('.') for part in relative_dir_path.split(os.sep))
-            # if file_ext_lower in IGNORED_EXTENSIONS or is_ignored_dir: # <--- This line was the problem
-            #     ignored_files += 1
-            #     continue
-            # --- ^ ^ ^ FAULTY CHECK REMOVED HERE ^ ^ ^ ---
-
-
-            # --- 2. Construct new filename base based on relative path ---
-            if relative_dir_path == '.':
-                # File is in the root input directory
-                new_filename_base = filename
-            else:
-                # File is in a subdirectory
-                prefix = relative_dir_path.replace(os.sep, '%')
-                safe_prefix = get_safe_filename(prefix)
-                new_filename_base = f"{safe_prefix}%{filename}"
-
-            # --- 3. Check if supported extension ---
-            if file_ext_lower in SUPPORTED_EXTENSIONS:
-                target_path = os.path.join(output_dir, new_filename_base)
-                try:
-                    shutil.copy2(source_path, target_path) # copy2 preserves metadata
-                    total_size += os.path.getsize(target_path)
-                    processed_files += 1
-                    # print(f"Copied: {filename} -> {new_filename_base}")
-                except Exception as e:
-                    print(f"Error copying {source_path} to {target_path}: {e}")
-                    error_files += 1
-
-            # --- 4. If not ignored and not supported, attempt to convert to .txt ---
-            else:
-                target_filename = f"{new_filename_base}.txt"
-                target_path = os.path.join(output_dir, target_filename)
-                try:
-                    # Try reading as UTF-8, replacing errors
-                    with open(source_path, 'r', encoding='utf-8', errors='replace') as infile:
-                        content = infile.read()
-
-                    # Write the content to the new .txt file
-                    with open(target_path, 'w', encoding='utf-8') as outfile:
-                        outfile.write(content)
-
-                    total_size += os.path.getsize(target_path)
-                    processed_files += 1
-                    converted_files += 1
-                    # print(f"Converted: {filename} -> {target_filename}")
+            with scan_it:
+                while True:
+                    # Like os.walk, an error while listing (EIO, stale NFS handle, directory
+                    # removed mid-listing) stops this directory only, not the whole run
+                    try:
+                        entry = next(scan_it)
+                    except StopIteration:
+                        break
+                    except OSError:
+                        break
+                    filename = entry.name
 
-                except UnicodeDecodeError:
-                    # File is likely binary
                     try:
-                         with open(target_path, 'w', encoding='utf-8') as outfile:
-                             outfile.write(f"[Content of '{filename}' could not be decoded as text (likely binary). Original extension: {ext}]")
-                         total_size += os.path.getsize(target_path)
-                         processed_files += 1
-                         converted_files += 1
-                         # print(f"Placeholder created for undecodable file: {filename} -> {target_filename}")
-                    except Exception as e:
-                        print(f"Error creating placeholder for {source_path} at {target_path}: {e}")
-                        error_files += 1
-                except MemoryError:
-                     print(f"Error: MemoryError while trying to read {source_path}. File might be too large to process this way.")
-                     error_files += 1
-                     try:
-                          with open(target_path, 'w', encoding='utf-8') as outfile:
-                              outfile.write(f"[Content of '{filename}' could not be read due to MemoryError (file too large?). Original extension: {ext}]")
-                          total_size += os.path.getsize(target_path) # Size of placeholder
-                          processed_files += 1
-                          converted_files += 1
-                     except Exception as e_mem:
-                         print(f"Error creating placeholder after MemoryError for {source_path}: {e_mem}")
-
-                except Exception as e:
-                    print(f"Error processing/converting {source_path} to {target_path}: {e}")
-                    error_files += 1
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                        is_file = not is_dir and entry.is_file()
+                    except OSError:
+                        is_dir = is_file = False
+
+                    if is_dir:
+                        # Don't descend into skipped/hidden directories
+                        # This is the primary mechanism for skipping whole directories
+                        if is_skipped_dir(filename) or filename[:1] == b'.':
+                            continue
+                        # Skip the output directory itself if the walk picks it up.
+                        # DirEntry.inode() is free on POSIX, so only stat on a match
+                        if entry.inode() == out_ino:
+                            try:
+                                entry_stat = entry.stat(follow_symlinks=False)
+                            except OSError:
+                                continue
+                            if (entry_stat.st_dev, entry_stat.st_ino) == output_id:
+                                continue
+                        pending_dirs.append((root_prefix + filename,
+                                             new_prefix + get_safe_filename(filename) + b'%'))
+                        continue
+                    if not is_file:
+                        # Broken symlinks, symlinked directories, FIFOs, sockets and entries
+                        # whose type can't be read aren't copied, but still count as skipped
+                        ignored_files += 1
+                        continue
+
+                    # Skip hidden files (e.g., .gitignore, .env)
+                    if filename.startswith(b'.'):
+                        ignored_files += 1
+                        continue
+
+                    source_path = entry.path
+                    # Only the final '.'-delimited suffix matters, rpartition is cheaper than splitext
+                    dot, _, ext = filename.rpartition(b'.')
+
+                    # --- 1. Look up the handler for the extension, None means ignored ---
+                    #    (The check for ignored *directories* is handled by the is_dir branch above)
+                    if dot:
+                        file_ext_lower = ext.lower()
+                        handler = handlers.get(file_ext_lower, CONVERT_HANDLER)
+                    else:
+                        # No extension can't match the table, so skip the lookup
+                        file_ext_lower = b''
+                        handler = CONVERT_HANDLER
+                    if handler is None:
+                        ignored_files += 1
+                        # print(f"Ignoring: {source_path} (Ignored Extension: {file_ext_lower})")
+                        continue
+
+                    # --- 2. Construct target path based on relative path ---
+                    #    (supported files keep their name, converted ones get .txt appended)
+                    process, suffix = handler
+                    target_path = output_join + new_prefix + filename + suffix
+                    is_conversion = process is convert_file
+                    if target_path in used_targets:
+                        errors.append((is_conversion, source_path, target_path,
+                                       "flattened name already used by another file, skipped"))
+                        continue
+                    used_targets.add(target_path)
+
+                    # --- 3. Copy or convert on the thread pool ---
+                    run = bound_handlers[process]
+                    pair_future = None
+                    try:
+                        size = entry.stat().st_size
+                    except OSError:
+                        # Hashed as usual, the job itself reports the error
+                        size = 0
+                    if size:
+                        if size not in first_of_size:
+                            if is_conversion:
+                                first_of_size[size] = None
+                            else:
+                                first_of_size[size] = source_path
+                                run = copy_unique_file
+                        elif first_of_size[size] is not None:
+                            # Hash the unhashed first file of this size too, once
+                            pair_future = executor.submit(hash_file, first_of_size[size])
+                            first_of_size[size] = None
+                    future = executor.submit(run, entry, target_path)
+                    future.add_done_callback(done_queue.put)
+                    in_flight.append((future, is_conversion, source_path, target_path, size, pair_future))
+                    # Pick up finished jobs while walking; wait only if the window is full
+                    drain(MAX_IN_FLIGHT)
+
+        # --- 4. Collect the jobs still running; counters are only updated from this thread ---
+        # Errors are gathered and written in one go after the loop, and progress is
+        # only reported every PROGRESS_MASK + 1 files
+        drain(1)
+
+    # List the skipped duplicates in the output, so the bundle still shows where
+    # each skipped file's content can be found
+    if duplicates:
+        input_prefix_len = len(os.fsencode(input_dir)) + len(sep)
+        output_prefix_len = len(output_join)
+        listing = DUPLICATES_LIST_HEADER + b''.join(
+            b'%s -> %s\n' % (source_path[input_prefix_len:], owner[output_prefix_len:])
+            for source_path, owner in duplicates)
+        # Don't overwrite a copied file that already has the listing's name
+        listing_name = DUPLICATES_LIST_NAME
+        listing_stem, listing_ext = os.path.splitext(DUPLICATES_LIST_NAME)
+        n = 1
+        while output_join + listing_name in used_targets:
+            n += 1
+            listing_name = b'%s_%d%s' % (listing_stem, n, listing_ext)
+        try:
+            write_bytes(output_join + listing_name, listing)
+            total_size += len(listing)
+        except OSError as e:
+            # Reported with the other errors; there is no source file, hence None
+            errors.append((False, None, output_join + listing_name, e))
+            listing_name = None
+    error_files += len(errors)
+
+    if errors:
+        sys.stdout.flush()
+        sys.stderr.write(''.join(map(format_error, errors)))
 
     # --- Final Summary & Warning ---
     # (This part remains the same)
@@ -213,6 +746,10 @@ def prepare_gemini_upload(input_dir, output_dir):
     print(f"Files processed (copied or converted): {processed_files}")
     print(f"Files converted to .txt: {converted_files}")
     print(f"Files/Directories ignored or skipped: {ignored_files}")
+    if duplicates:
+         print(f"Duplicate files skipped (identical content already copied): {len(duplicates)}")
+         if listing_name is not None:
+             print(f"  (listed in '{os.fsdecode(listing_name)}' in the output folder)")
     if error_files > 0:
          print(f"Errors encountered: {error_files}")
 
@@ -240,6 +777,8 @@ if __name__ == "__main__":
                         help="Path to the source directory containing your project files.")
     parser.add_argument("output_dir",
                         help="Path to the destination directory where the processed files will be saved.\nThis directory will be created if it doesn't exist.")
+    parser.add_argument("--transcode-processes", type=int, default=0, metavar="N",
+                        help="Re-encode large text files on N worker processes (default: 0, off).\nOnly helps on multi-core machines with big text files; ignored with one CPU.")
 
     print("Gemini File Prep Tool")
     print("---------------------\n")
@@ -252,4 +791,4 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    prepare_gemini_upload(args.input_dir, args.output_dir)
\ No newline at end of file
+    prepare_gemini_upload(args.input_dir, args.output_dir, args.transcode_processes)
\ No newline at end of file